@@ -1,13 +1,24 @@
+import csv
+import io
 import json
 import os
+import queue
+import random
+import shutil
+import socket
+import threading
 import time
-import urllib.request
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 
-import geopandas as gpd
+import numpy as np
+import pandas as pd
+import requests
+import shapely
 from dotenv import load_dotenv
 from pyogrio import read_dataframe
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 load_dotenv()
@@ -17,14 +28,115 @@ scrape_type = 0
 samples_per_country = 400
 pano = True
 num_workers = 5
-image_list = []
-# Cache to store loaded GeoDataFrames to prevent reloading
+# Downloads are network-bound, so the thread count is capped by API limits rather than CPU count
+max_workers = 64
+# Headings for the sample points at cardinal directions: North, East, South, West
+cardinal_headings = np.array([2, 92, 182, 272])
+# Cache to store the road locations (latitude and longitude arrays) of each region and (regions, country) pair
 gdf_cache = {}
+# Random generator used to sample road locations
+rng = np.random.default_rng()
+# Shared HTTP session so worker threads reuse keep-alive connections to the Maps API
+session = requests.Session()
+maps_host = 'maps.googleapis.com'
+request_timeout = 10
+# URL templates for the Street View image and metadata endpoints, built once at load
+image_url_template = (f"https://{maps_host}/maps/api/streetview?size=640x640&fov=120"
+                      "&location={lat},{lon}&heading={heading}&key={key}&return_error_code=true")
+meta_url_template = f"https://{maps_host}/maps/api/streetview/metadata?location={{lat}},{{lon}}&key={{key}}"
+# Chunk size used when reading image bodies from the network
+read_chunk_size = 64 * 1024
+# Full-jitter exponential backoff settings (seconds) and the errors worth retrying
+backoff_base = 1.0
+backoff_cap = 30
+retryable_errors = (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# Thread pool shared by every batch and country of a scrape, created when the scrape starts
+EXECUTOR = None
+# Bounded queue of (image bytes, path) pairs saved to disk by a dedicated writer thread
+write_queue = None
+writer_thread = None
+# Paths the writer thread failed to save, so their images are not counted or recorded
+failed_writes = set()
+failed_writes_lock = threading.Lock()
+# Panorama IDs already downloaded this session, shared by the worker threads
+seen_panos = set()
+seen_panos_lock = threading.Lock()
+# Rounded "lat,lon" keys of locations with no imagery and the date they were recorded, persisted so later runs skip them
+negative_locations_path = './cache/negative_locations.txt'
+negative_locations = {}
+# Street View coverage grows, so locations are queried again once their entry is this old
+negative_locations_max_age = timedelta(days=180)
+negative_locations_lock = threading.Lock()
 
 # Load the JSON file as a dictionary
 json_file_path = './regions_to_countries.json'
 with open(json_file_path, 'r') as f:
     regions_to_countries_dict = json.load(f)
+# Invert the dictionary to look up the regions of a country directly, in the order they are listed
+country_to_regions = {country: [region for region, countries in regions_to_countries_dict.items() if country in countries]
+                      for countries in regions_to_countries_dict.values()
+                      for country in countries}
+
+# Directory where region road locations are stored as Parquet after the first shapefile load
+region_cache_dir = './GRIP4/cache'
+# Directory where each country's road locations are stored after filtering them to its boundary
+country_cache_dir = os.path.join(region_cache_dir, 'countries')
+# Natural Earth admin 0 country boundaries, used to keep only the roads inside the scraped country
+country_boundaries_path = './NaturalEarth/ne_10m_admin_0_countries.shp'
+# Country boundaries, read on the first country that is not already cached
+country_boundaries = None
+# Natural Earth ADM0_A3 codes for country names in the regions JSON that differ from Natural Earth's names
+country_boundary_codes = {
+    "Bahamas": ["BHS"],
+    "British Virgin Islands": ["VGB"],
+    "Brunei Darussalam": ["BRN"],
+    "Cape Verde": ["CPV"],
+    "Christmas Island": ["IOA"],
+    "Congo": ["COG"],
+    "Cote d'Ivoire": ["CIV"],
+    "Czech Republic": ["CZE"],
+    "Democratic People's Republic of Korea": ["PRK"],
+    "Democratic Republic of the Congo": ["COD"],
+    "Falkland Islands (Malvinas)": ["FLK"],
+    "French Guiana": ["FRA"],
+    "French Southern Territories": ["ATF"],
+    "Guadeloupe": ["FRA"],
+    "Iran (Islamic Republic of)": ["IRN"],
+    "Lao People's Democratic Republic": ["LAO"],
+    "Libyan Arab Jamahiriya": ["LBY"],
+    "Martinique": ["FRA"],
+    "Mayotte": ["FRA"],
+    "Moldova, Republic of": ["MDA"],
+    "Netherlands Antilles": ["CUW", "SXM", "NLD"],
+    "Occupied Palestinian Territory": ["PSX"],
+    "Republic of Korea": ["KOR"],
+    "Reunion": ["FRA"],
+    "Russian Federation": ["RUS"],
+    "Saint Helena, Ascension and Tristan da Cunha": ["SHN"],
+    "Sao Tome and Principe": ["STP"],
+    "Swaziland": ["SWZ"],
+    "Syrian Arab Republic": ["SYR"],
+    "Taiwan, Province of China": ["TWN"],
+    "The former Yugoslav Republic of Macedonia": ["MKD"],
+    "Timor-Leste": ["TLS"],
+    "United Kingdom of Great Britain and Northern Ireland": ["GBR"],
+    "United Republic of Tanzania": ["TZA"],
+    "United States Virgin Islands": ["VIR"],
+    "United States of America": ["USA"],
+    "Viet Nam": ["VNM"],
+    "Wallis and Futuna": ["WLF"],
+    "Western Sahara": ["SAH"]
+}
+# Extents (min lon, min lat, max lon, max lat) that separate territories sharing a Natural Earth entry,
+# such as the French overseas departments inside France's multipolygon
+country_boundary_extents = {
+    "French Guiana": (-54.7, 2.0, -51.5, 5.9),
+    "Guadeloupe": (-61.9, 15.8, -60.9, 16.6),
+    "Martinique": (-61.3, 14.3, -60.7, 14.95),
+    "Mayotte": (44.9, -13.1, 45.4, -12.5),
+    "Netherlands Antilles": (-69.3, 11.9, -62.9, 18.2),
+    "Reunion": (55.1, -21.5, 55.9, -20.8)
+}
 
 # Dictionary to map regions to shapefiles
 region_shp_paths = {
@@ -38,155 +150,519 @@ region_shp_paths = {
 }
 
 
+def _extract_first_vertices(gdf):
+    """
+    Extracts the first vertex of every road geometry in a single vectorized pass.
+
+    Parameters:
+        gdf (GeoDataFrame): GeoDataFrame containing the road geometries of a region.
+
+    Returns:
+        tuple: Two float64 NumPy arrays holding the latitude and longitude of each road's first vertex.
+    """
+    geoms = gdf.geometry.to_numpy()
+
+    # Keep only LineStrings (type id 1) and MultiLineStrings (type id 5)
+    geoms = geoms[np.isin(shapely.get_type_id(geoms), (1, 5))]
+
+    # In case of multiple lines, take the first line segment of each road
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+    _, first_parts = np.unique(part_index, return_index=True)
+
+    # Extract latitude and longitude of the first vertex of each line
+    coords, coord_index = shapely.get_coordinates(parts[first_parts], return_index=True)
+    _, first_coords = np.unique(coord_index, return_index=True)
+    lons, lats = coords[first_coords].T
+
+    return np.ascontiguousarray(lats), np.ascontiguousarray(lons)
+
+
+def save_vertices(vertices, cache_path):
+    """
+    Saves latitude and longitude arrays to a Parquet file, replacing it only once the write has finished.
+
+    Parameters:
+        vertices (tuple): Latitude and longitude arrays to save.
+        cache_path (str): The path of the Parquet file.
+
+    Returns:
+        None
+    """
+    # Write to a temporary file first so an interrupted write never leaves a truncated cache behind
+    tmp_path = cache_path + '.tmp'
+    pd.DataFrame({'lat': vertices[0], 'lon': vertices[1]}).to_parquet(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def load_region_vertices(region):
+    """
+    Loads the road locations for the given region.
+
+    Parameters:
+        region (str): The name of the region to load the road locations for.
+
+    Returns:
+        tuple: Latitude and longitude arrays of the first vertex of every road in the region.
+
+    Raises:
+        ValueError: If the shapefile path for the region is not found.
+    """
+    # If region is cached, use the cached road locations
+    if region in gdf_cache:
+        print(f"Using cached road locations for {region}")
+        return gdf_cache[region]
+    # If region was saved by a previous run, read it back from Parquet
+    cache_path = os.path.join(region_cache_dir, f"{region.replace(' ', '_')}_vertices.parquet")
+    if os.path.exists(cache_path):
+        print(f"Loading cached road locations for {region}: {cache_path}")
+        df = pd.read_parquet(cache_path)
+        vertices = (df['lat'].to_numpy(), df['lon'].to_numpy())
+        gdf_cache[region] = vertices
+        return vertices
+    else:
+        # Load the shapefile for the region and cache its road locations for future use
+        shapefile_path = region_shp_paths.get(region)
+        if shapefile_path:
+            print(f"Loading shapefile for {region}: {shapefile_path}")
+            # Only the geometry is used downstream, so skip reading the attribute columns
+            gdf = read_dataframe(shapefile_path, columns=[], use_arrow=True)
+            vertices = _extract_first_vertices(gdf)
+            os.makedirs(region_cache_dir, exist_ok=True)
+            save_vertices(vertices, cache_path)
+            gdf_cache[region] = vertices
+            return vertices
+        else:
+            raise ValueError(f"Shapefile path for {region} not found.")
+
+
+def load_country_boundary(country):
+    """
+    Loads the boundary of the given country from the Natural Earth dataset.
+
+    Parameters:
+        country (str): The name of the country to load the boundary for.
+
+    Returns:
+        shapely.Geometry: The country's (multi)polygon, or None if the dataset or country is not available.
+                          Territories spread over several Natural Earth entries are merged into one geometry,
+                          and territories sharing an entry are clipped to their own extent.
+    """
+    global country_boundaries
+    if country_boundaries is None:
+        if not os.path.exists(country_boundaries_path):
+            return None
+        country_boundaries = read_dataframe(country_boundaries_path,
+                                            columns=['ADM0_A3', 'ADMIN', 'NAME_LONG', 'NAME_EN', 'FORMAL_EN'])
+
+    # Match by code for names Natural Earth spells differently, otherwise by any of its name fields
+    if country in country_boundary_codes:
+        matches = country_boundaries[country_boundaries['ADM0_A3'].isin(country_boundary_codes[country])]
+    else:
+        name_fields = country_boundaries[['ADMIN', 'NAME_LONG', 'NAME_EN', 'FORMAL_EN']]
+        matches = country_boundaries[(name_fields == country).any(axis=1)]
+    if matches.empty:
+        return None
+    boundary = shapely.union_all(matches.geometry.to_numpy())
+
+    # Cut territories out of the entry they share so each keeps only its own roads
+    if country in country_boundary_extents:
+        boundary = shapely.clip_by_rect(boundary, *country_boundary_extents[country])
+    return boundary
+
+
+def filter_to_boundary(vertices, boundary):
+    """
+    Keeps only the road locations that fall inside the given boundary.
+
+    Parameters:
+        vertices (tuple): Latitude and longitude arrays of the first vertex of each road in a region.
+        boundary (shapely.Geometry): The (multi)polygon to keep the road locations inside.
+
+    Returns:
+        tuple: Latitude and longitude arrays of the roads inside the boundary.
+    """
+    # Use the bounding box to pick candidates, then test only those against the exact boundary
+    lats, lons = vertices
+    minx, miny, maxx, maxy = boundary.bounds
+    idx = np.flatnonzero((lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy))
+    shapely.prepare(boundary)
+    idx = idx[shapely.intersects_xy(boundary, lons[idx], lats[idx])]
+    return lats[idx], lons[idx]
+
+
 def load_shapefile_for_country(country):
     """
-    Loads the shapefile for the given country based on the region it belongs to.
+    Loads the road locations for the given country from every region it belongs to.
 
     Parameters:
-        country (str): The name of the country to load the shapefile for.
+        country (str): The name of the country to load the road locations for.
 
     Returns:
-        gpd.GeoDataFrame: The GeoDataFrame containing road geometries for the region of the country.
+        tuple: Latitude and longitude arrays of the first vertex of every road in the country.
 
     Raises:
-        ValueError: If the shapefile path for the region is not found or the country is not found in any region.
-    """
-    # Loop through each region in the JSON file to find which region the country belongs to
-    for region, countries in regions_to_countries_dict.items():
-        if country in countries:
-            # If region is cached, use the cached GeoDataFrame
-            if region in gdf_cache:
-                print(f"Using cached GeoDataFrame for {region}")
-                return gdf_cache[region]
-            else:
-                # Load the shapefile for the region and cache it for future use
-                shapefile_path = region_shp_paths.get(region)
-                if shapefile_path:
-                    print(f"Loading shapefile for {region}: {shapefile_path}")
-                    gdf = read_dataframe(shapefile_path)
-                    gdf_cache[region] = gdf
-                    return gdf
-                else:
-                    raise ValueError(f"Shapefile path for {region} not found.")
-    # If the country is not found in the JSON data, raise an error
-    raise ValueError(f"{country} not found in any region.")
+        ValueError: If the shapefile path for a region is not found, the country is not found in any region,
+                    or no roads fall inside the country's boundary.
+    """
+    # Look up which regions the country belongs to
+    regions = country_to_regions.get(country)
+    if regions is None:
+        # If the country is not found in the JSON data, raise an error
+        raise ValueError(f"{country} not found in any region.")
+
+    # If the country was already filtered out of its regions, use the cached road locations
+    cache_key = (tuple(regions), country)
+    if cache_key in gdf_cache:
+        print(f"Using cached road locations for {country}")
+        return gdf_cache[cache_key]
+    # If the country was filtered by a previous run, read it back without loading its regions
+    cache_path = os.path.join(country_cache_dir, f"{str(country).replace(' ', '_')}_vertices.parquet")
+    if os.path.exists(cache_path):
+        print(f"Loading cached road locations for {country}: {cache_path}")
+        df = pd.read_parquet(cache_path)
+        vertices = (df['lat'].to_numpy(), df['lon'].to_numpy())
+        gdf_cache[cache_key] = vertices
+        return vertices
+
+    boundary = load_country_boundary(country)
+    if boundary is None:
+        print(f"No boundary found for {country}, sampling from its whole region")
+        parts = [load_region_vertices(region) for region in regions]
+    else:
+        parts = [filter_to_boundary(load_region_vertices(region), boundary) for region in regions]
+    vertices = (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]))
+
+    if boundary is not None:
+        if len(vertices[0]) == 0:
+            raise ValueError(f"No roads found inside the boundary of {country}, skipping it.")
+        # Only save countries that were actually filtered, so adding boundaries later takes effect
+        os.makedirs(country_cache_dir, exist_ok=True)
+        save_vertices(vertices, cache_path)
+    gdf_cache[cache_key] = vertices
+    return vertices
+
+
+def configure_session(workers):
+    """
+    Mounts a connection pool on the shared session sized for the number of worker threads.
+
+    Parameters:
+        workers (int): The number of threads that will share the session.
+
+    Returns:
+        None
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers * 2)
+    session.mount("https://", adapter)
+
+
+configure_session(num_workers)
+
+
+def warm_up_connections():
+    """
+    Opens the pooled connections to the Maps API before the first batch is submitted.
+
+    Returns:
+        None
+    """
+    # Check that the host resolves so an offline machine is reported once instead of by every request
+    try:
+        socket.getaddrinfo(maps_host, 443, proto=socket.IPPROTO_TCP)
+    except OSError as e:
+        print(f"Could not resolve {maps_host}: {e}")
+        return
+
+    # Each request completes a TCP and TLS handshake and leaves the connection in the session's pool
+    futures = [
+        EXECUTOR.submit(session.head, f"https://{maps_host}/", timeout=request_timeout)
+        for _ in range(num_workers)
+    ]
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except requests.exceptions.RequestException:
+            pass
+
 
 # The following function is adapted from Street_View_API_scraping https://github.com/BLorenzoF/Street_View_API_scraping.git
-def generate_ll(gdf, n2d=200):
+def generate_ll(vertices, untried, n2d=200):
     """
-    Generates latitude and longitude coordinates for sampling from road geometries.
+    Generates latitude and longitude coordinates for sampling from road locations.
 
     Parameters:
-        gdf (GeoDataFrame): GeoDataFrame containing the road geometries of the country.
+        vertices (tuple): Latitude and longitude arrays of the first vertex of each road.
+        untried (np.ndarray): Indices of the road locations not sampled yet, in random order.
         n2d (int): Number of points to generate (default is 200).
 
     Returns:
-        list: A list of latitude, longitude, and heading (N, E, S, W) for each sample point.
+        tuple: A list of latitude, longitude, and headings (N, E, S, W) for each sample location,
+               and the indices of the road locations that are still untried.
     """
     # Calculate the number of roads to sample based on the desired number of points
-    n_roads = int(n2d / 2)
-    ll_list = []
-
-    # Sample the roads if the dataset contains more roads than needed
-    roads = gdf.sample(n=n_roads) if len(gdf) > n_roads else gdf
-
-    # Loop through each road and extract latitude and longitude for sampling
-    for road in roads['geometry']:
-        if road.geom_type == 'LineString':
-            lat, lon = road.xy[1][0], road.xy[0][0]
-        elif road.geom_type == 'MultiLineString':
-            # In case of multiple lines, take the first line segment
-            first_line = road.geoms[0]
-            lat, lon = first_line.xy[1][0], first_line.xy[0][0]
-        else:
-            continue
-
-        # Create sample points at cardinal directions: North, East, South, West
-        point_N = (lat, lon, 2)
-        point_E = (lat, lon, 92)
-        point_S = (lat, lon, 182)
-        point_W = (lat, lon, 272)
+    n_roads = max(1, int(n2d / 2))
 
-        # Append the generated points to the list
-        ll_list.append(point_N)
-        ll_list.append(point_E)
-        ll_list.append(point_S)
-        ll_list.append(point_W)
+    # Take the next roads from the shuffled indices so no location is sampled twice
+    idx, untried = untried[:n_roads], untried[n_roads:]
+    lat, lon = vertices[0][idx], vertices[1][idx]
 
-    return ll_list
+    # Group the cardinal directions per location so each location needs a single metadata lookup
+    headings = cardinal_headings.tolist()
+    return [(la, lo, headings) for la, lo in zip(lat.tolist(), lon.tolist())], untried
 
 # The following function is adapted from Street_View_API_scraping https://github.com/BLorenzoF/Street_View_API_scraping.git
-def MetaParse(MetaUrl):
+@lru_cache(maxsize=100_000)
+def MetaParse(Lat, Lon):
     """
     Fetches and parses the metadata from the Google Street View API.
 
+    Results are cached per location, so callers should round the coordinates (e.g. to 5 decimals).
+
     Parameters:
-        MetaUrl (str): The URL to request metadata from the Google Street View API.
+        Lat (float): The latitude of the location.
+        Lon (float): The longitude of the location.
 
     Returns:
         tuple: A tuple containing the date, panorama ID, latitude, and longitude if successful, otherwise None.
+               The panorama ID is None if no imagery exists at the location.
     """
+    MetaUrl = meta_url_template.format(lat=Lat, lon=Lon, key=key)
     try:
-        # Send a request to the provided metadata URL
-        response = urllib.request.urlopen(MetaUrl)
-        jsonRaw = response.read()
-        jsonData = json.loads(jsonRaw)
+        # Send a request to the metadata URL
+        response = session.get(MetaUrl, timeout=request_timeout)
+        response.raise_for_status()
+        jsonData = response.json()
 
         # Check if the response contains valid data and extract metadata
         if jsonData['status'] == "OK":
             return (jsonData.get('date', None), jsonData['pano_id'], jsonData['location']['lat'], jsonData['location']['lng'])
+        elif jsonData['status'] in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+            # Raise rather than return so transient failures are retried and never cached
+            raise requests.exceptions.HTTPError(f"Metadata request failed with status {jsonData['status']}", response=response)
+        elif jsonData['status'] in ("ZERO_RESULTS", "NOT_FOUND"):
+            return (None, None, Lat, Lon)
         else:
             return None
+    except retryable_errors:
+        # Let transient network errors reach the caller's retry loop
+        raise
     except Exception as e:
         # Catch and print any errors that occur during the metadata fetch
         print(f"Error fetching metadata: {e}")
         return None
 
 
+def backoff_delay(attempt, response=None):
+    """
+    Computes how long to wait before the next retry using full-jitter exponential backoff.
+
+    Parameters:
+        attempt (int): The zero-based number of the attempt that just failed.
+        response (requests.Response): The failed response, if any, checked for a Retry-After header.
+
+    Returns:
+        float: The number of seconds to sleep.
+    """
+    delay = random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+    if response is not None:
+        # Never retry sooner than the server asked us to
+        try:
+            delay = max(delay, float(response.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+
+def fetch_image(ImageUrl):
+    """
+    Downloads a Street View image into memory.
+
+    Parameters:
+        ImageUrl (str): The URL to request the image from the Google Street View API.
+
+    Returns:
+        bytes: The image content if imagery is available, otherwise None.
+    """
+    with session.get(ImageUrl, stream=True, timeout=request_timeout) as response:
+        # With return_error_code set, the API answers 404 instead of a grey "no imagery" placeholder
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        # Read the body in large chunks, decoding any gzip transfer encoding
+        response.raw.decode_content = True
+        buffer = io.BytesIO()
+        shutil.copyfileobj(response.raw, buffer, length=read_chunk_size)
+        return buffer.getvalue()
+
+
+def load_negative_locations():
+    """
+    Loads the locations known to have no imagery from previous runs, dropping expired entries.
+
+    Returns:
+        None
+    """
+    negative_locations.clear()
+    if not os.path.exists(negative_locations_path):
+        return
+    oldest = datetime.now().date() - negative_locations_max_age
+    with open(negative_locations_path, 'r') as f:
+        for line in f:
+            # Each line is "lat,lon,YYYY-MM-DD"; skip malformed lines
+            location, _, recorded = line.strip().rpartition(',')
+            try:
+                recorded = datetime.strptime(recorded, '%Y-%m-%d').date()
+            except ValueError:
+                continue
+            if recorded >= oldest:
+                negative_locations[location] = recorded
+
+
+def save_negative_locations():
+    """
+    Saves the locations known to have no imagery so later runs can skip them.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(negative_locations_path), exist_ok=True)
+    with negative_locations_lock:
+        locations = sorted(negative_locations.items())
+    with open(negative_locations_path, 'w') as f:
+        f.writelines(f"{location},{recorded.isoformat()}\n" for location, recorded in locations)
+
+
+def disk_writer():
+    """
+    Saves downloaded images to disk from the write queue until it receives None.
+
+    Returns:
+        None
+    """
+    while True:
+        item = write_queue.get()
+        try:
+            if item is None:
+                return
+            content, path = item
+            with open(path, 'wb') as f:
+                f.write(content)
+        except Exception as e:
+            print(f"Error saving image: {e}")
+            with failed_writes_lock:
+                failed_writes.add(path)
+        finally:
+            write_queue.task_done()
+
+
+def call_with_retries(func, *args, retries=3):
+    """
+    Calls a request function, retrying transient HTTP and connection errors with backoff.
+
+    Parameters:
+        func (callable): The function performing the request.
+        *args: Arguments passed to the function.
+        retries (int): Number of attempts before giving up (default is 3).
+
+    Returns:
+        The return value of the function.
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt fails.
+    """
+    for attempt in range(retries):
+        try:
+            return func(*args)
+        except retryable_errors as e:
+            if attempt == retries - 1:
+                raise
+            # Retry after a randomized, growing delay
+            delay = backoff_delay(attempt, e.response)
+            print(f"{type(e).__name__}: {e}, retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+
+
 # The following function is adapted from Street_View_API_scraping https://github.com/BLorenzoF/Street_View_API_scraping.git
-def GetStreetLL(Lat, Lon, Head, SaveLoc, retries=3):
+def GetStreetLL(Lat, Lon, Headings, SaveLoc, retries=3):
     """
-    Downloads a Street View image from the given latitude, longitude, and heading.
+    Downloads Street View images from the given latitude and longitude for each heading.
 
     Parameters:
         Lat (float): The latitude of the location.
         Lon (float): The longitude of the location.
-        Head (int): The heading in degrees (N, E, S, W).
-        SaveLoc (str): The directory where the image will be saved.
-        retries (int): Number of retry attempts for downloading the image (default is 3).
+        Headings (list): The headings in degrees (N, E, S, W).
+        SaveLoc (str): The directory where the images will be saved.
+        retries (int): Number of retry attempts for each request (default is 3).
 
     Returns:
-        tuple: A tuple containing metadata and the success flag (1 for success, 0 for failure).
+        tuple: A list containing metadata for each saved image and the number of images saved.
     """
-    # Construct the base URL for fetching the Street View image
-    base = r"https://maps.googleapis.com/maps/api/streetview"
-    size = r"?size=640x640&fov=120&location="
-    end = f"{Lat},{Lon}&heading={Head}&key={key}"
-    MyUrl = base + size + end
-    MetaUrl = base + r"/metadata" + size + end
+    image_metadata = []
+    Lat, Lon = round(Lat, 5), round(Lon, 5)
 
-    for attempt in range(retries):
+    # Skip locations that returned no imagery in this or a previous run
+    location = f"{Lat},{Lon}"
+    with negative_locations_lock:
+        if location in negative_locations:
+            return image_metadata, 0
+
+    try:
+        # Fetch metadata once for all headings; it is free of quota and is the only source of pano_id and date
+        met_data = call_with_retries(MetaParse, Lat, Lon, retries=retries)
+    except Exception as e:
+        print(f"Error fetching metadata: {e}")
+        return image_metadata, 0
+    if not met_data:
+        return image_metadata, 0
+    if not met_data[1]:
+        with negative_locations_lock:
+            negative_locations[location] = datetime.now().date()
+        return image_metadata, 0
+    date, pano_id, lat, lon = met_data
+
+    # Skip panoramas that another location already resolved to
+    with seen_panos_lock:
+        if pano_id in seen_panos:
+            return image_metadata, 0
+        seen_panos.add(pano_id)
+
+    for Head in Headings:
+        MyUrl = image_url_template.format(lat=Lat, lon=Lon, heading=Head, key=key)
+        filename = f"{lat}_{lon}_{int(Head)}.jpg"
         try:
-            # Fetch metadata for the location
-            met_data = MetaParse(MetaUrl)
-            if met_data:
-                date, pano_id, lat, lon = met_data
-                if pano_id:
-                    # Construct the filename and save the image
-                    filename = f"{lat}_{lon}_{int(Head)}.jpg"
-                    urllib.request.urlretrieve(MyUrl, os.path.join(SaveLoc, filename))
-                    return [(date, pano_id, lat, lon, filename), 1]
-        except urllib.error.HTTPError as e:
-            # Handle HTTP errors and retry after a delay
-            print(f"HTTPError: {e}, retrying in 5 seconds...")
-            time.sleep(5)
+            # Download the image into memory and hand it to the writer thread
+            content = call_with_retries(fetch_image, MyUrl, retries=retries)
+            if content is not None:
+                write_queue.put((content, os.path.join(SaveLoc, filename)))
+                image_metadata.append((date, pano_id, lat, lon, filename))
         except Exception as e:
-            # Handle other exceptions and print the error message
+            # Handle exceptions and print the error message
             print(f"Error downloading image: {e}")
-            return None, 0
 
-    # If all retry attempts fail, return failure
-    return None, 0
+    # If every heading failed, release the panorama so another location can still download it
+    if not image_metadata:
+        with seen_panos_lock:
+            seen_panos.discard(pano_id)
+
+    return image_metadata, len(image_metadata)
+
+
+def download_location(location, save_dir):
+    """
+    Downloads the images for one sample location, never raising so a batch is not cut short.
+
+    Parameters:
+        location (tuple): The latitude, longitude, and headings of the sample location.
+        save_dir (str): The directory where the images will be saved.
+
+    Returns:
+        tuple: A list containing metadata for each saved image and the number of images saved.
+    """
+    try:
+        return GetStreetLL(location[0], location[1], location[2], save_dir)
+    except Exception as e:
+        print(f"Error downloading image: {e}")
+        return [], 0
 
 
 def download_images_from_country(country_name, total_images_to_download, save_dir):
@@ -199,43 +675,67 @@ def download_images_from_country(country_name, total_images_to_download, save_di
         save_dir (str): The directory where the images will be saved.
 
     Returns:
-        None
+        list: Metadata (date, panorama ID, latitude, longitude, filename) for each downloaded image.
     """
-    # Load the shapefile containing the road geometries for the country
-    gdf = load_shapefile_for_country(country_name)
+    # Load the road locations for the country
+    vertices = load_shapefile_for_country(country_name)
     images_downloaded = 0
+    image_list = []
+    # Shuffle the road locations once so each is tried at most once and the loop ends when they run out
+    untried = rng.permutation(len(vertices[0]))
 
     # Continue downloading images until the required number of images is reached
     while images_downloaded < total_images_to_download * 4:
         n2d = total_images_to_download - int(images_downloaded / 4)
-        data_list = generate_ll(gdf, n2d)
+        data_list, untried = generate_ll(vertices, untried, n2d)
 
         if not data_list:
-            print("No points generated, exiting.")
+            print(f"All road locations in {country_name} have been tried, exiting.")
             break
 
-        # Use a thread pool to download images concurrently
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            futures = [
-                executor.submit(GetStreetLL, i[0], i[1], i[2], save_dir)
-                for i in data_list
-            ]
+        # Use the shared thread pool to download images concurrently, feeding workers in order
+        results = EXECUTOR.map(lambda i: download_location(i, save_dir), data_list)
 
-            # Process the results from the threads
-            for future in tqdm(as_completed(futures), total=len(futures),
-                               desc=f'Downloading Images from {country_name}'):
-                try:
-                    result = future.result()
-                    if result:
-                        image_metadata, images_downloaded_in_current_iteration = result
-                        images_downloaded += images_downloaded_in_current_iteration
+        # Process the results from the threads
+        for image_metadata, images_downloaded_in_current_iteration in tqdm(
+                results, total=len(data_list), desc=f'Downloading Images from {country_name}'):
+            images_downloaded += images_downloaded_in_current_iteration
 
-                        if image_metadata:
-                            image_list.append(image_metadata)
-                except Exception as e:
-                    print(f"Error downloading image: {e}")
+            if image_metadata:
+                image_list.extend(image_metadata)
+
+        # Wait for the writer thread to save this batch, then drop the images it failed to save
+        write_queue.join()
+        with failed_writes_lock:
+            failed = failed_writes.copy()
+            failed_writes.clear()
+        if failed:
+            saved = [image for image in image_list if os.path.join(save_dir, image[4]) not in failed]
+            images_downloaded -= len(image_list) - len(saved)
+            image_list = saved
 
     print(f"Downloaded {images_downloaded} images from {country_name}.")
+    return image_list
+
+
+def save_image_metadata(csv_path, country_name, image_list):
+    """
+    Appends the metadata of a country's downloaded images to a CSV file.
+
+    Parameters:
+        csv_path (str): The path of the CSV file, created with a header row if it does not exist.
+        country_name (str): The name of the country the images were scraped from.
+        image_list (list): Metadata (date, panorama ID, latitude, longitude, filename) for each image.
+
+    Returns:
+        None
+    """
+    write_header = not os.path.exists(csv_path)
+    with open(csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(['country', 'date', 'pano_id', 'lat', 'lon', 'filename'])
+        writer.writerows((country_name, *image_metadata) for image_metadata in image_list)
 
 def start_menu():
     """
@@ -343,6 +843,8 @@ def setApiKey():
     global key
     api_key = input("Enter your API key: ")
     key = api_key
+    # Cached metadata lookups were made with the previous key
+    MetaParse.cache_clear()
     print("Key Set!")
 
 
@@ -408,11 +910,14 @@ def configureScrape():
     while True:
         print("How many threads would you like to use?")
         choice = abs(int(input("> ")))
-        if 1 <= choice <= os.cpu_count():
+        if 1 <= choice <= max_workers:
+            if choice > 32:
+                print("Warning: high thread counts may exceed your Maps API rate limit.")
             num_workers = choice
+            configure_session(num_workers)
             break
         else:
-            print(f"Please enter a valid number between 1 and {os.cpu_count()}.")
+            print(f"Please enter a valid number between 1 and {max_workers}.")
 
 
 def verify_config():
@@ -443,44 +948,59 @@ def main():
     Returns:
         None
     """
-    global image_list
-    image_list = []
+    global EXECUTOR
+    global write_queue
+    global writer_thread
     DownLoc = "./Downloads"
+    # Start every scrape with no panoramas marked as downloaded
+    seen_panos.clear()
+    metadata_path = os.path.join(DownLoc, 'image_metadata.csv')
+    EXECUTOR = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='sv')
+    write_queue = queue.Queue(maxsize=num_workers * 4)
+    writer_thread = threading.Thread(target=disk_writer, name='sv-writer', daemon=True)
+    writer_thread.start()
+    load_negative_locations()
+
+    try:
+        warm_up_connections()
 
-    if scrape_type == 1:
-        # Scrape multiple countries from a file
-        file_path = 'countries_to_scrape.txt'
+        if scrape_type == 1:
+            # Scrape multiple countries from a file
+            file_path = 'countries_to_scrape.txt'
 
-        with open(file_path, 'r') as file:
-            countries_to_scrape = [line.strip() for line in file.readlines()]
+            with open(file_path, 'r') as file:
+                countries_to_scrape = [line.strip() for line in file.readlines()]
 
-        for country_name in countries_to_scrape:
+            for country_name in countries_to_scrape:
+                print(f"Starting scrape for {country_name}")
+                country_dir = os.path.join(DownLoc, country_name)
+                os.makedirs(country_dir, exist_ok=True)
+
+                try:
+                    image_list = download_images_from_country(country_name, total_images_to_download=samples_per_country, save_dir=country_dir)
+                    save_image_metadata(metadata_path, country_name, image_list)
+                except Exception as e:
+                    print(f"Error scraping images: {e}")
+                    continue
+
+                print(f"Scrape completed for {country_name}\n")
+        else:
+            # Scrape an individual country
+            country_name = input("What country would you like to scrape: ")
             print(f"Starting scrape for {country_name}")
             country_dir = os.path.join(DownLoc, country_name)
-            if not os.path.exists(country_dir):
-                os.mkdir(country_dir)
-                print(f'Created dir: {country_dir}\n')
+            os.makedirs(country_dir, exist_ok=True)
 
             try:
-                download_images_from_country(country_name, total_images_to_download=samples_per_country, save_dir=country_dir)
+                image_list = download_images_from_country(country_name, total_images_to_download=samples_per_country, save_dir=country_dir)
+                save_image_metadata(metadata_path, country_name, image_list)
             except Exception as e:
                 print(f"Error scraping images: {e}")
-                continue
-
             print(f"Scrape completed for {country_name}\n")
-    else:
-        # Scrape an individual country
-        country_name = input("What country would you like to scrape: ")
-        print(f"Starting scrape for {country_name}")
-        country_dir = os.path.join(DownLoc, country_name)
-        if not os.path.exists(country_dir):
-            os.mkdir(country_dir)
-            print(f'Created dir: {country_dir}\n')
-
-        try:
-            download_images_from_country(country_name, total_images_to_download=samples_per_country, save_dir=country_dir)
-        except Exception as e:
-            print(f"Error scraping images: {e}")
-        print(f"Scrape completed for {country_name}\n")
+    finally:
+        EXECUTOR.shutdown()
+        write_queue.put(None)
+        writer_thread.join()
+        save_negative_locations()
 
 start_menu()
\ No newline at end of file